@@ -1,11 +1,17 @@
 import json
 from pathlib import Path
-from typing import Dict, Optional, List
+from typing import Dict, Optional, List, Tuple
 from datetime import datetime
 import hashlib
 from dataclasses import dataclass, asdict
 
 
+# Parsed blockchain files by resolved path, reused while the file is unchanged.
+# Each entry holds the file version (mtime, size), the blocks and the
+# transaction history lookups done on them.
+_BLOCKCHAIN_CACHE: Dict[str, Tuple[Tuple[int, int], Dict[str, 'Block'], Dict[str, tuple]]] = {}
+
+
 @dataclass
 class BlockHeader:
     """Block header containing metadata"""
@@ -71,6 +77,12 @@ class Blockchain:
     def __init__(self, blockchain_file: str = "blockchainDB_2.json"):
         self.blockchain_file = Path(blockchain_file)
         self.blocks: Dict[str, Block] = {}
+        # Embedding transactions by data type, built on first use
+        self._by_data_type: Optional[Dict[str, List[Tuple[Block, dict]]]] = None
+        # get_transaction_history results by image hash
+        self._history_cache: Dict[str, tuple] = {}
+        # Last embedding of every image hash, built by build_hash_index
+        self._by_hash: Optional[Dict[str, tuple]] = None
         self.load_blockchain()
 
         # Create genesis block if blockchain is empty
@@ -97,9 +109,30 @@ class Blockchain:
         self.save_blockchain()
         print("Genesis block created and saved")
 
+    def _file_version(self) -> Tuple[int, int]:
+        """Return (mtime, size) of the blockchain file, used to detect changes."""
+        stat = self.blockchain_file.stat()
+        return stat.st_mtime_ns, stat.st_size
+
+    def _update_cache(self) -> None:
+        """Record the blocks just written to the blockchain file."""
+        self._history_cache = {}
+        _BLOCKCHAIN_CACHE[str(self.blockchain_file.resolve())] = (
+            self._file_version(), dict(self.blocks), self._history_cache
+        )
+
     def load_blockchain(self) -> None:
-        """Load blockchain from file."""
+        """Load blockchain from file, reusing the parsed blocks if the file is unchanged."""
+        self._by_data_type = None
+        self._by_hash = None
+        self._history_cache = {}
         if self.blockchain_file.exists():
+            cached = _BLOCKCHAIN_CACHE.get(str(self.blockchain_file.resolve()))
+            if cached is not None and cached[0] == self._file_version():
+                _, blocks, self._history_cache = cached
+                self.blocks = dict(blocks)
+                return
+
             try:
                 with open(self.blockchain_file, 'r') as f:
                     blockchain_data = json.load(f)
@@ -107,6 +140,7 @@ class Blockchain:
                         block_num: Block.from_dict(block_data)
                         for block_num, block_data in blockchain_data.items()
                     }
+                self._update_cache()
             except json.JSONDecodeError:
                 print("Error loading blockchain file. Creating new blockchain.")
                 self.blocks = {}
@@ -127,6 +161,8 @@ class Blockchain:
         with open(self.blockchain_file, 'w') as f:
             json.dump(blockchain_data, f, indent=2)
 
+        self._update_cache()
+
     def get_latest_block_number(self) -> int:
         """Get the number of the latest block."""
         if not self.blocks:
@@ -162,6 +198,11 @@ class Blockchain:
         self.blocks[str(new_block_num)] = new_block
         self.save_blockchain()
 
+        if self._by_data_type is not None:
+            self._index_block(new_block)
+        if self._by_hash is not None:
+            self._index_hashes(str(new_block_num), new_block)
+
         return new_block
 
     def verify_chain(self) -> bool:
@@ -184,8 +225,75 @@ class Blockchain:
         """Get a block by its number."""
         return self.blocks.get(str(block_number))
 
+    def _index_block(self, block: Block) -> None:
+        """Add the embedding transactions of a block to the data type index."""
+        if block.info == "embedder":
+            for transaction in block.transaction["transaction_dict"].values():
+                self._by_data_type.setdefault(transaction["data_type"], []).append((block, transaction))
+
+    def get_transactions_by_data_type(self, data_type: str) -> List[Tuple[Block, dict]]:
+        """Get the (block, transaction) pairs of all embeddings of a data type, in chain order."""
+        if self._by_data_type is None:
+            self._by_data_type = {}
+            for block in self.blocks.values():
+                self._index_block(block)
+        return self._by_data_type.get(data_type, [])
+
+    @staticmethod
+    def _history(block_num: str, block: Block, transaction: dict) -> dict:
+        """History entry of an embedding transaction."""
+        return {
+            'block_number': block_num,
+            'block_hash': block.hash,
+            'timestamp': block.header.timestamp,
+            'info': block.info,
+            'image_hash': transaction['hash_image_wat']
+        }
+
+    def _index_hashes(self, block_num: str, block: Block) -> None:
+        """Add the embedding transactions of a block to the image hash index."""
+        if block.info != "embedder":
+            return
+        # Within a block the first matching transaction wins, later blocks
+        # replace earlier ones, as in _find_transaction
+        block_index = {}
+        for transaction in block.transaction["transaction_dict"].values():
+            if not transaction:
+                continue
+            for image_hash in (transaction['hash_image_wat'], transaction.get('hash_file_wat')):
+                if image_hash is not None and image_hash not in block_index:
+                    block_index[image_hash] = (self._history(block_num, block, transaction), transaction)
+        self._by_hash.update(block_index)
+
+    def build_hash_index(self) -> Dict[str, tuple]:
+        """
+        Index the last embedding of every image hash in a single pass over the chain.
+
+        Once built, get_transaction_history looks images up in the index
+        instead of scanning the chain, which batch processing relies on.
+
+        Returns:
+            Dict[str, tuple]: (history, transaction) by watermarked image or file hash
+        """
+        if self._by_hash is None:
+            self._by_hash = {}
+            for block_num, block in self.blocks.items():
+                self._index_hashes(block_num, block)
+        return self._by_hash
+
     def get_transaction_history(self, image_hash: str):
         """Get all transactions related to a specific image."""
+        if self._by_hash is not None:
+            history, transaction_current = self._by_hash.get(image_hash, ({}, {}))
+            return dict(history), transaction_current
+        if image_hash not in self._history_cache:
+            self._history_cache[image_hash] = self._find_transaction(image_hash)
+        history, transaction_current = self._history_cache[image_hash]
+        # Callers update the history, keep the cached one intact
+        return dict(history), transaction_current
+
+    def _find_transaction(self, image_hash: str):
+        """Scan the chain for the last embedding of an image."""
         history = {}
         transaction_current = {}
         for block_num, block in self.blocks.items():
@@ -193,16 +301,10 @@ class Blockchain:
                 for idx, transaction in block.transaction["transaction_dict"].items():
                     if transaction and (
                             transaction['hash_image_wat'] == image_hash
-
+                            or transaction.get('hash_file_wat') == image_hash
                     ):
                         transaction_current = transaction
-                        history = {
-                            'block_number': block_num,
-                            'block_hash': block.hash,
-                            'timestamp': block.header.timestamp,
-                            'info': block.info,
-                            'image_hash': transaction['hash_image_wat']
-                        }
+                        history = self._history(block_num, block, transaction)
                         break
         return history, transaction_current
 
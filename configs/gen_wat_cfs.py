@@ -24,6 +24,7 @@ class ExtractConfig:
     blockchain_path: str
     data_type: str
     operation_type: str = "extraction"
+    skip_hash_lookup: bool = False
 
 
 @dataclass
@@ -0,0 +1,119 @@
+import json
+import os
+
+import pytest
+
+from blockchain.blockchain import Blockchain
+
+
+def _transaction(image_hash: str, data_type: str = "png", **fields) -> dict:
+    return {"hash_image_wat": image_hash, "hash_file_wat": "file_" + image_hash,
+            "data_type": data_type, **fields}
+
+
+def _add(blockchain: Blockchain, *transactions: dict, info: str = "embedder") -> None:
+    blockchain.add_transaction(
+        {"transaction_dict": {str(i): transaction for i, transaction in enumerate(transactions)}}, info=info
+    )
+
+
+@pytest.fixture
+def chain_path(tmp_path):
+    return str(tmp_path / "chain.json")
+
+
+def _hashes(pairs) -> list:
+    return [transaction["hash_image_wat"] for _, transaction in pairs]
+
+
+def test_reload_after_external_write_with_new_size(chain_path):
+    blockchain = Blockchain(chain_path)
+    _add(blockchain, _transaction("a"))
+    assert _hashes(Blockchain(chain_path).get_transactions_by_data_type("png")) == ["a"]
+
+    # Another process appends a block
+    other = json.loads(open(chain_path).read())
+    other["2"] = dict(other["1"], transaction={"transaction_dict": {"0": _transaction("b")}})
+    with open(chain_path, "w") as f:
+        json.dump(other, f)
+
+    assert _hashes(Blockchain(chain_path).get_transactions_by_data_type("png")) == ["a", "b"]
+    _, transaction = Blockchain(chain_path).get_transaction_history("b")
+    assert transaction["hash_image_wat"] == "b"
+
+
+def test_reload_after_external_write_with_same_size(chain_path):
+    blockchain = Blockchain(chain_path)
+    _add(blockchain, _transaction("a"))
+    assert Blockchain(chain_path).get_transaction_history("a")[1]
+
+    # Same length content, only the modification time tells the file changed
+    content = open(chain_path).read()
+    with open(chain_path, "w") as f:
+        f.write(content.replace('"a"', '"z"'))
+    stat = os.stat(chain_path)
+    os.utime(chain_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert os.stat(chain_path).st_size == stat.st_size
+
+    reloaded = Blockchain(chain_path)
+    assert reloaded.get_transaction_history("a") == ({}, {})
+    assert reloaded.get_transaction_history("z")[1]["hash_image_wat"] == "z"
+
+
+def test_add_transaction_updates_indexes(chain_path):
+    blockchain = Blockchain(chain_path)
+    _add(blockchain, _transaction("a"))
+    assert _hashes(blockchain.get_transactions_by_data_type("png")) == ["a"]
+    blockchain.build_hash_index()
+
+    _add(blockchain, _transaction("b"), _transaction("c", data_type="dcm"))
+    _add(blockchain, _transaction("d"), info="remover")
+
+    assert _hashes(blockchain.get_transactions_by_data_type("png")) == ["a", "b"]
+    assert _hashes(blockchain.get_transactions_by_data_type("dcm")) == ["c"]
+    for image_hash in ("b", "file_b", "c", "file_c"):
+        history, transaction = blockchain.get_transaction_history(image_hash)
+        assert history["block_number"] == "2"
+        assert transaction["hash_image_wat"] == image_hash[-1]
+    assert blockchain.get_transaction_history("d") == ({}, {})
+
+    # Same indexes as a fresh build from the file
+    reloaded = Blockchain(chain_path)
+    reloaded.build_hash_index()
+    assert reloaded.build_hash_index() == blockchain.build_hash_index()
+    assert _hashes(reloaded.get_transactions_by_data_type("png")) == ["a", "b"]
+
+
+@pytest.mark.parametrize("indexed", [False, True], ids=["scan", "index"])
+def test_later_block_overrides_earlier(chain_path, indexed):
+    blockchain = Blockchain(chain_path)
+    _add(blockchain, _transaction("a", message="first"))
+    _add(blockchain, _transaction("a", message="second"))
+    if indexed:
+        blockchain.build_hash_index()
+
+    history, transaction = blockchain.get_transaction_history("a")
+
+    assert history["block_number"] == "2"
+    assert transaction["message"] == "second"
+
+
+def test_history_same_with_and_without_index(chain_path):
+    blockchain = Blockchain(chain_path)
+    _add(blockchain, _transaction("a"), _transaction("b"))
+    # Within a block the first transaction for a hash wins
+    _add(blockchain, _transaction("b", message="first"), _transaction("b", message="second"),
+         {}, _transaction("c", data_type="dcm"))
+    _add(blockchain, _transaction("a", message="removed"), info="remover")
+    _add(blockchain, _transaction("c", message="last"))
+    image_hashes = ["a", "b", "c", "file_a", "file_b", "file_c", "missing"]
+
+    scanned = {image_hash: blockchain.get_transaction_history(image_hash) for image_hash in image_hashes}
+    indexed = Blockchain(chain_path)
+    indexed.build_hash_index()
+
+    for image_hash in image_hashes:
+        assert indexed.get_transaction_history(image_hash) == scanned[image_hash]
+    assert scanned["b"][1]["message"] == "first"
+    assert scanned["c"][1]["message"] == "last"
+    assert "message" not in scanned["a"][1]
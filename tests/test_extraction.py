@@ -0,0 +1,112 @@
+import numpy as np
+import pytest
+
+import watermarking.watermark_extractor as watermark_extractor
+from blockchain.blockchain import Blockchain
+from configs.gen_wat_cfs import ExtractConfig
+from tests.test_roundtrip import KERNELS, _embed, _test_image
+from watermarking.utils import hex_to_binary_array, load_grayscale_image
+from watermarking.watermark_extractor import WatermarkExtractor
+
+
+def _use_numba(monkeypatch, numba: bool) -> None:
+    if numba and not watermark_extractor.NUMBA_AVAILABLE:
+        pytest.skip("numba is not installed")
+    monkeypatch.setattr(watermark_extractor, "NUMBA_AVAILABLE", numba)
+
+
+def _smooth_image() -> np.ndarray:
+    """Gradient image with little noise, small prediction errors carry many bits."""
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[:256, :256]
+    return (60 + y // 4 + x // 5 + rng.integers(-1, 2, y.shape)).astype(np.uint8)
+
+
+def _embed_watermarked(tmp_path, kernel_name: str, stride: int):
+    """Embed a watermark, returns the watermarked image, its transaction and the blockchain."""
+    blockchain = _embed(tmp_path, _smooth_image(), KERNELS[kernel_name], stride, t_hi=1)
+    (block, transaction), = blockchain.get_transactions_by_data_type("png")
+    return load_grayscale_image(tmp_path / "watermarked.png"), transaction, blockchain
+
+
+@pytest.mark.parametrize("numba", [True, False], ids=["numba", "numpy"])
+# Strides below the kernel size overlap the windows, the others do not
+@pytest.mark.parametrize("kernel_name, stride", [
+    ("cross", 2), ("cross", 3), ("cross", 4),
+    ("tenths", 2), ("tenths", 3),
+    ("thirds", 2), ("thirds", 3),
+    ("ring_5x5", 3), ("ring_5x5", 5),
+    ("ring_4x4", 4), ("ring_4x4", 5),
+])
+def test_shared_predictions_match(tmp_path, monkeypatch, kernel_name, stride, numba):
+    _use_numba(monkeypatch, numba)
+    watermarked, transaction, _ = _embed_watermarked(tmp_path, kernel_name, stride)
+
+    bits, bits_256 = WatermarkExtractor._extract_watermark_from_image(None, watermarked, transaction)
+    shared_bits, shared_bits_256 = WatermarkExtractor._extract_watermark_from_image(
+        None, watermarked, transaction, {}
+    )
+
+    np.testing.assert_array_equal(shared_bits, bits)
+    np.testing.assert_array_equal(shared_bits_256, bits_256)
+    # Every extracted bit matches the watermark, sums are counts or zero
+    original_watermark = hex_to_binary_array(transaction["watermark"])
+    assert bits_256[:, 1].sum() == len(bits)
+    np.testing.assert_array_equal(bits_256[:, 0], bits_256[:, 1] * original_watermark)
+
+
+@pytest.mark.parametrize("numba", [True, False], ids=["numba", "numpy"])
+@pytest.mark.parametrize("predictions", [None, {}], ids=["own", "shared"])
+@pytest.mark.parametrize("kernel_name, stride", [("cross", 2), ("cross", 3), ("ring_5x5", 5)])
+def test_non_contiguous_image(tmp_path, monkeypatch, kernel_name, stride, predictions, numba):
+    _use_numba(monkeypatch, numba)
+    watermarked, transaction, _ = _embed_watermarked(tmp_path, kernel_name, stride)
+
+    for image in (watermarked.T, np.rot90(watermarked), np.asfortranarray(watermarked.astype(np.int32))):
+        assert not image.flags.c_contiguous
+        expected = WatermarkExtractor._extract_watermark_from_image(
+            None, np.ascontiguousarray(image), transaction, None if predictions is None else {}
+        )
+        result = WatermarkExtractor._extract_watermark_from_image(
+            None, image, transaction, None if predictions is None else {}
+        )
+        for array, expected_array in zip(result, expected):
+            np.testing.assert_array_equal(array, expected_array)
+
+
+@pytest.mark.parametrize("numba", [True, False], ids=["numba", "numpy"])
+@pytest.mark.parametrize("decoy", [False, True], ids=["one_candidate", "two_candidates"])
+def test_extract_from_array(tmp_path, monkeypatch, decoy, numba):
+    _use_numba(monkeypatch, numba)
+    watermarked, transaction, blockchain = _embed_watermarked(tmp_path, "cross", 3)
+    block_number = 1
+    if decoy:
+        # Same parameters with the complemented watermark, checked first,
+        # the second candidate reuses its predictions
+        blockchain = Blockchain(str(tmp_path / "decoy_chain.json"))
+        decoy_watermark = format(int(transaction["watermark"], 16) ^ (2 ** 256 - 1), "064x")
+        decoy_transaction = dict(transaction, watermark=decoy_watermark, hash_image_wat="decoy")
+        for transaction_current in (decoy_transaction, transaction):
+            blockchain.add_transaction({"transaction_dict": {"0": transaction_current}}, info="embedder")
+        block_number = 2
+
+    config = ExtractConfig(data_path=str(tmp_path / "watermarked.png"),
+                           blockchain_path=str(blockchain.blockchain_file),
+                           data_type="png", skip_hash_lookup=True)
+    history = WatermarkExtractor(config).extract_from_array(watermarked)
+
+    assert history["ber"] == 0
+    assert history["block_number"] == block_number
+    assert history["image_hash"] == transaction["hash_image_wat"]
+
+
+def test_extract_from_array_unknown_image(tmp_path):
+    _embed_watermarked(tmp_path, "cross", 3)
+    config = ExtractConfig(data_path=str(tmp_path / "watermarked.png"),
+                           blockchain_path=str(tmp_path / "chain.json"),
+                           data_type="png", skip_hash_lookup=True)
+
+    history = WatermarkExtractor(config).extract_from_array(_test_image(1, saturated=False))
+
+    assert history["ber"] == 0.5
+    assert history["block_number"] is None
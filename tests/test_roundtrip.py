@@ -0,0 +1,112 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+import watermarking.watermark_remover as watermark_remover
+from blockchain.blockchain import Blockchain
+from configs.gen_wat_cfs import ConfigGenerator, EmbedConfig, RemoveConfig
+from watermarking.watermark_embedder import WatermarkEmbedder
+from watermarking.watermark_remover import WatermarkRemove
+
+KERNELS = {
+    "cross": ConfigGenerator.DEFAULT_KERNEL,
+    # Non-dyadic weights, the window sums are rounded and their order matters
+    "tenths": [[0.1, 0.15, 0.1], [0.15, 0, 0.15], [0.1, 0.15, 0.1]],
+    "thirds": [[0, 1 / 3, 0], [1 / 3, 0, 1 / 3], [0, 0, 0]],
+    "ring_5x5": [[0 if (i, j) == (2, 2) else 1 / 24 for j in range(5)] for i in range(5)],
+    "ring_4x4": [[0 if (i, j) == (2, 2) else 1 / 15 for j in range(4)] for i in range(4)],
+}
+SECRET_KEY = "5e" * 32
+
+
+def _test_image(seed: int, saturated: bool) -> np.ndarray:
+    """Noisy gradient image, with a sprinkle of 254 and 255 pixels if saturated."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[:192, :192]
+    image = (20 + y // 2 + x // 3 + rng.integers(-8, 9, y.shape)).astype(np.uint8)
+    if saturated:
+        image[rng.random(image.shape) < 0.01] = 255
+        image[rng.random(image.shape) < 0.01] = 254
+    return image
+
+
+def _embed(tmp_path, image: np.ndarray, kernel, stride: int, t_hi: int) -> Blockchain:
+    """
+    Embed a watermark in image, saved as tmp_path / "watermarked.png", and
+    record the transaction in a new blockchain, which is returned.
+    """
+    Image.fromarray(image).save(tmp_path / "original.png")
+    embed_config = EmbedConfig(data_path=str(tmp_path / "original.png"),
+                               save_path=str(tmp_path / "watermarked.png"),
+                               blockchain_path=str(tmp_path / "chain.json"),
+                               message="roundtrip", kernel=kernel, stride=stride, t_hi=t_hi,
+                               bit_depth=8, data_type="png")
+    embedder = WatermarkEmbedder(embed_config)
+    # Fixed key, the embedded positions and so the overflows are reproducible
+    embedder.secret_key = SECRET_KEY
+    transaction = embedder.embed_watermarks()
+
+    blockchain = Blockchain(str(tmp_path / "chain.json"))
+    blockchain.add_transaction({"transaction_dict": {transaction.hash_image_wat: transaction.to_dict()}},
+                               info="embedder")
+    return blockchain
+
+
+def _embed_and_remove(tmp_path, image: np.ndarray, kernel, stride: int, t_hi: int) -> np.ndarray:
+    """Embed a watermark in image, then remove it, returns the recovered image."""
+    blockchain = _embed(tmp_path, image, kernel, stride, t_hi)
+    remove_config = RemoveConfig(data_path=str(tmp_path / "watermarked.png"),
+                                 save_path=str(tmp_path / "recovered.png"),
+                                 ext_wat_path=str(tmp_path / "watermark"),
+                                 blockchain_path=str(tmp_path / "chain.json"),
+                                 data_type="png")
+    remover = WatermarkRemove(remove_config, blockchain)
+    watermarked, _ = remover._load_image()
+    assert not np.array_equal(watermarked, image)
+    return remover.remove_from_array(watermarked).recovered_image
+
+
+@pytest.mark.parametrize("numba", [True, False], ids=["numba", "numpy"])
+@pytest.mark.parametrize("saturated", [False, True], ids=["plain", "saturated"])
+# Strides below the kernel size overlap the windows, the others do not
+@pytest.mark.parametrize("kernel_name, stride", [
+    ("cross", 2), ("cross", 3), ("cross", 4),
+    ("tenths", 2), ("tenths", 3), ("tenths", 4),
+    ("thirds", 2), ("thirds", 3),
+    ("ring_5x5", 3), ("ring_5x5", 5), ("ring_5x5", 6),
+    ("ring_4x4", 4), ("ring_4x4", 5),
+])
+def test_remove_restores_original(tmp_path, monkeypatch, kernel_name, stride, saturated, numba):
+    if numba and not watermark_remover.NUMBA_AVAILABLE:
+        pytest.skip("numba is not installed")
+    monkeypatch.setattr(watermark_remover, "NUMBA_AVAILABLE", numba)
+
+    image = _test_image(stride, saturated)
+    recovered = _embed_and_remove(tmp_path, image, KERNELS[kernel_name], stride, t_hi=1)
+
+    np.testing.assert_array_equal(recovered, image)
+
+
+@pytest.mark.parametrize("numba", [True, False], ids=["numba", "numpy"])
+@pytest.mark.parametrize("kernel_name, stride", [("cross", 2), ("cross", 3), ("ring_5x5", 5)])
+def test_remove_fortran_ordered(tmp_path, monkeypatch, kernel_name, stride, numba):
+    if numba and not watermark_remover.NUMBA_AVAILABLE:
+        pytest.skip("numba is not installed")
+    monkeypatch.setattr(watermark_remover, "NUMBA_AVAILABLE", numba)
+
+    image = _test_image(stride, saturated=False)
+    blockchain = _embed(tmp_path, image, KERNELS[kernel_name], stride, t_hi=1)
+    remove_config = RemoveConfig(data_path=str(tmp_path / "watermarked.png"),
+                                 save_path=str(tmp_path / "recovered.png"),
+                                 ext_wat_path=None,
+                                 blockchain_path=str(tmp_path / "chain.json"),
+                                 data_type="png")
+    remover = WatermarkRemove(remove_config, blockchain)
+    watermarked, _ = remover._load_image()
+    fortran = np.asfortranarray(watermarked)
+
+    recovered = remover.remove_from_array(fortran).recovered_image
+
+    np.testing.assert_array_equal(recovered, image)
+    # The input is left watermarked
+    np.testing.assert_array_equal(fortran, watermarked)
@@ -1,5 +1,6 @@
 # utils.py
 import hashlib
+from functools import lru_cache
 import numpy as np
 
 
@@ -26,6 +27,10 @@ def sha256_to_binary_np_array(input_string):
     return binary_np_array
 
 
+# Cached since every image of a batch, and every attack of a robustness test,
+# asks for the positions of the same key and size. Entries are image sized,
+# so only a few are kept
+@lru_cache(maxsize=8)
 def generate_random_binary_array_from_string(seed_string, array_size):
     # Compute the SHA-256 hash of the seed string
     sha256_hash = hashlib.sha256(seed_string.encode()).digest()
@@ -38,6 +43,8 @@ def generate_random_binary_array_from_string(seed_string, array_size):
 
     # Generate a random binary array
     random_binary_array = rng.integers(0, 2, size=array_size, dtype=np.uint8)
+    # Shared between callers, make sure nobody modifies it
+    random_binary_array.setflags(write=False)
 
     return random_binary_array
 
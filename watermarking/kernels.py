@@ -0,0 +1,174 @@
+import numpy as np
+
+try:
+    from numba import njit, prange, types
+    NUMBA_AVAILABLE = True
+except ImportError:
+    # Without Numba the kernels run as plain Python
+    NUMBA_AVAILABLE = False
+    prange = range
+    types = None
+
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+# Results of extract_position besides the extracted bit
+NO_BIT = -1
+OVERFLOW = 2
+
+
+@njit(cache=True)
+def extract_position(image, y_center, x_center, neighbors, t_hi, max_pixel_value):
+    """
+    Extract the bit of one kernel position and restore its center pixel.
+
+    Shared by the compiled extraction and removal loops.
+
+    Returns:
+        int: the extracted bit, NO_BIT if the position carries none or
+        OVERFLOW if the center pixel is saturated
+    """
+    center = image[y_center, x_center]
+    error_w = center - neighbors
+    if error_w < 0:
+        return NO_BIT
+
+    if center == max_pixel_value - 1:
+        return OVERFLOW
+
+    if error_w > (2 * t_hi + 1):
+        image[y_center, x_center] = neighbors + error_w - t_hi - 1
+        return NO_BIT
+
+    # error_w >= 0 here, so & 1 and >> 1 match % 2 and // 2
+    image[y_center, x_center] = neighbors + (error_w >> 1)
+    return error_w & 1
+
+
+# np.sum adds short arrays one term after another and longer ones pairwise,
+# by blocks of 8 terms (numpy's pairwise_sum). The predictions follow the
+# same order as the embedder's np.sum(region * kernel), otherwise floor()
+# can differ for weights that are not exact in binary (0.1, 1/3, ...).
+_PAIRWISE_UNROLL = 8
+_PAIRWISE_BLOCK = 128
+
+
+@njit(cache=True)
+def window_taps(kernel):
+    """
+    Row offsets, column offsets and weights of the kernel taps in row-major
+    order, computed once per kernel for window_sum.
+    """
+    k_height, k_width = kernel.shape
+    n = k_height * k_width
+    tap_y = np.empty(n, np.int64)
+    tap_x = np.empty(n, np.int64)
+    weights = np.empty(n, np.float64)
+    for i in range(n):
+        tap_y[i] = i // k_width
+        tap_x[i] = i % k_width
+        weights[i] = kernel[tap_y[i], tap_x[i]]
+    return tap_y, tap_x, weights
+
+
+@njit(inline='always')
+def _window_block_sum(image, y_start, x_start, tap_y, tap_x, weights, start, n):
+    """Sum of the window terms start to start + n, n <= 128, in np.sum's order."""
+    if n < _PAIRWISE_UNROLL:
+        res = 0.0
+        for i in range(start, start + n):
+            res += image[y_start + tap_y[i], x_start + tap_x[i]] * weights[i]
+        return res
+
+    r0 = r1 = r2 = r3 = r4 = r5 = r6 = r7 = 0.0
+    n_unrolled = n - n % _PAIRWISE_UNROLL
+    for i in range(start, start + n_unrolled, _PAIRWISE_UNROLL):
+        r0 += image[y_start + tap_y[i], x_start + tap_x[i]] * weights[i]
+        r1 += image[y_start + tap_y[i + 1], x_start + tap_x[i + 1]] * weights[i + 1]
+        r2 += image[y_start + tap_y[i + 2], x_start + tap_x[i + 2]] * weights[i + 2]
+        r3 += image[y_start + tap_y[i + 3], x_start + tap_x[i + 3]] * weights[i + 3]
+        r4 += image[y_start + tap_y[i + 4], x_start + tap_x[i + 4]] * weights[i + 4]
+        r5 += image[y_start + tap_y[i + 5], x_start + tap_x[i + 5]] * weights[i + 5]
+        r6 += image[y_start + tap_y[i + 6], x_start + tap_x[i + 6]] * weights[i + 6]
+        r7 += image[y_start + tap_y[i + 7], x_start + tap_x[i + 7]] * weights[i + 7]
+    res = ((r0 + r1) + (r2 + r3)) + ((r4 + r5) + (r6 + r7))
+    for i in range(start + n_unrolled, start + n):
+        res += image[y_start + tap_y[i], x_start + tap_x[i]] * weights[i]
+    return res
+
+
+@njit(inline='always')
+def window_sum(image, y_start, x_start, tap_y, tap_x, weights):
+    """
+    Kernel weighted sum of the window at (y_start, x_start), equal to
+    np.sum(image[window] * kernel). The taps come from window_taps(kernel).
+    """
+    n = weights.size
+    if n <= _PAIRWISE_BLOCK:
+        return _window_block_sum(image, y_start, x_start, tap_y, tap_x, weights, 0, n)
+
+    # np.sum splits longer sums in two halves, recursively. Numba does not
+    # cache recursive functions, so walk the split tree with a stack of
+    # (start, size, step) frames, partial holding the left half sums
+    frames = np.empty((64, 3), np.int64)
+    partial = np.empty(64)
+    frames[0, 0], frames[0, 1], frames[0, 2] = 0, n, 0
+    top = 0
+    value = 0.0
+    while top >= 0:
+        start, size, step = frames[top, 0], frames[top, 1], frames[top, 2]
+        half = size // 2
+        half -= half % _PAIRWISE_UNROLL
+        if size <= _PAIRWISE_BLOCK:
+            value = _window_block_sum(image, y_start, x_start, tap_y, tap_x, weights, start, size)
+            top -= 1
+        elif step == 0:
+            frames[top, 2] = 1
+            top += 1
+            frames[top, 0], frames[top, 1], frames[top, 2] = start, half, 0
+        elif step == 1:
+            partial[top] = value
+            frames[top, 2] = 2
+            top += 1
+            frames[top, 0], frames[top, 1], frames[top, 2] = start + half, size - half, 0
+        else:
+            value = partial[top] + value
+            top -= 1
+    return value
+
+
+def _add(a, b):
+    """a + b, None standing for an exact zero."""
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return a + b
+
+
+def pairwise_sum(terms):
+    """
+    Sum of the terms in np.sum's order, for arrays of window terms.
+
+    Terms that are None are exact zeros and skipped, adding 0.0 does not
+    change a floating point sum. Returns 0.0 if every term is None.
+    """
+    n = len(terms)
+    if n < _PAIRWISE_UNROLL:
+        res = None
+        for term in terms:
+            res = _add(res, term)
+    elif n <= _PAIRWISE_BLOCK:
+        r = list(terms[:_PAIRWISE_UNROLL])
+        n_unrolled = n - n % _PAIRWISE_UNROLL
+        for i in range(_PAIRWISE_UNROLL, n_unrolled, _PAIRWISE_UNROLL):
+            for j in range(_PAIRWISE_UNROLL):
+                r[j] = _add(r[j], terms[i + j])
+        res = _add(_add(_add(r[0], r[1]), _add(r[2], r[3])), _add(_add(r[4], r[5]), _add(r[6], r[7])))
+        for term in terms[n_unrolled:]:
+            res = _add(res, term)
+    else:
+        n_half = n // 2
+        n_half -= n_half % _PAIRWISE_UNROLL
+        res = _add(pairwise_sum(terms[:n_half]), pairwise_sum(terms[n_half:]))
+    return 0.0 if res is None else res
@@ -1,6 +1,8 @@
+import os
 import secrets
 import hashlib
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
 from typing import Tuple, Union, List
 from PIL import Image
@@ -105,6 +107,7 @@ def bits_to_hexdigest(bits):
     return "".join(hex_digits)
 
 
+@lru_cache(maxsize=1024)
 def hex_to_binary_array(hex_string):
     """
     Converts a hexadecimal string to a NumPy array of binary bits.
@@ -121,18 +124,60 @@ def hex_to_binary_array(hex_string):
     for char in hex_string:
         hex_value = int(char, scale)
         bits.extend([int(bit) for bit in bin(hex_value)[2:].zfill(num_of_bits)])
-    return np.array(bits)
+    bits = np.array(bits)
+    # Cached and shared between callers, make sure nobody modifies it
+    bits.setflags(write=False)
+    return bits
+
+
+def majority_bits(extracted_bits_256: np.ndarray) -> np.ndarray:
+    """
+    Majority vote of the bits extracted for each of the 256 watermark bits.
+
+    Args:
+        extracted_bits_256: (256, 2) per-bit sums and counts
+
+    Returns:
+        int8 array of 256 bits, 0 for bits that were never extracted
+    """
+    # sums > counts / 2 without dividing, so empty counts give 0 instead of NaN
+    return (2 * extracted_bits_256[:, 0] > extracted_bits_256[:, 1]).astype(np.int8)
+
+
+def load_grayscale_image(path: Union[str, Path]) -> np.ndarray:
+    """
+    Load an image file as a grayscale array, same result as
+    np.array(Image.open(path).convert('L')).
+
+    Images that are already 8-bit grayscale skip PIL's conversion copy.
+    """
+    with Image.open(path) as image:
+        if image.mode != 'L':
+            image = image.convert('L')
+        return np.array(image)
 
 
 def compute_hash(data: Union[np.ndarray, Image.Image]) -> str:
     """Compute SHA-256 hash of image data."""
     if isinstance(data, np.ndarray):
-        data_bytes = data.tobytes()
+        # Hash the array buffer directly, a copy is only made for non-contiguous arrays
+        data_bytes = memoryview(np.ascontiguousarray(data))
     else:
         data_bytes = data.tobytes()
     return hashlib.sha256(data_bytes).hexdigest()
 
 
+def compute_file_hash(path: Union[str, Path]) -> str:
+    """Compute SHA-256 hash of a file's content, read in chunks."""
+    with open(path, 'rb') as f:
+        if hasattr(hashlib, "file_digest"):  # Python 3.11+
+            return hashlib.file_digest(f, "sha256").hexdigest()
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            digest.update(chunk)
+        return digest.hexdigest()
+
+
 def generate_watermark(message: str, secret_key: str) -> np.ndarray:
     """Generate watermark from message and secret key."""
     combined_input = message + secret_key
@@ -155,8 +200,11 @@ def get_image_files(supported_formats, directory: str) -> List[Path]:
     if not directory_path.exists():
         raise FileNotFoundError(f"Directory not found: {directory}")
 
-    image_files = []
-    for ext in supported_formats:
-        image_files.extend(directory_path.glob(f"*{ext}"))
+    # One directory pass, matching extensions case-insensitively
+    with os.scandir(directory_path) as entries:
+        image_files = [
+            Path(entry.path) for entry in entries
+            if entry.is_file() and os.path.splitext(entry.name)[1].lower() in supported_formats
+        ]
 
-    return sorted(set(image_files))
+    return sorted(image_files)
@@ -1,6 +1,5 @@
 import hashlib
 import secrets
-from copy import deepcopy
 from typing import Dict, Tuple, Union
 import numpy as np
 from PIL import Image
@@ -10,7 +9,7 @@ from dataclasses import dataclass
 from pydicom import dcmread
 
 from watermarking.utils import string_to_sha256_bits, generate_secret_key, verify_secret_key, compute_hash, \
-    generate_watermark
+    compute_file_hash, generate_watermark, load_grayscale_image
 
 
 @dataclass
@@ -28,6 +27,11 @@ class EmbedderTransaction:
     bit_depth: int
     data_type: str
     operation_type: str
+    hash_file_wat: str = ""
+
+    def to_dict(self) -> dict:
+        """Convert transaction to dictionary (shallow, the fields are plain values)."""
+        return vars(self).copy()
 
 
 class WatermarkEmbedder:
@@ -112,10 +116,9 @@ class WatermarkEmbedder:
             image_np = ds.pixel_array
         else:
             # Load and prepare image
-            image = Image.open(self.config.data_path).convert('L')
-            image_np = np.array(image)
+            image_np = load_grayscale_image(self.config.data_path)
 
-        original_image = deepcopy(image_np)
+        original_image = image_np.copy()
         # Prepare parameters
         kernel = np.array(self.config.kernel)
         watermark = generate_watermark(self.config.message, self.secret_key)
@@ -186,7 +189,7 @@ class WatermarkEmbedder:
             ds.save_as(self.config.save_path)
         else:
             # Load and prepare image
-            watermarked_image = Image.fromarray(np.uint8(image_np))
+            watermarked_image = Image.fromarray(image_np.astype(np.uint8, copy=False))
             watermarked_image.save(self.config.save_path)
 
         # Generate final watermark hash
@@ -209,7 +212,8 @@ class WatermarkEmbedder:
             hash_image_orig=compute_hash(original_image),
             bit_depth=self.bit_depth,
             data_type=self.config.data_type,
-            operation_type=self.config.operation_type
+            operation_type=self.config.operation_type,
+            hash_file_wat=compute_file_hash(self.config.save_path)
         )
 
         print(f"Watermark embedding completed successfully")
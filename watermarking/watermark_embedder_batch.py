@@ -1,15 +1,23 @@
+import copy
+import multiprocessing
 import os
 from pathlib import Path
-from typing import Dict, List, Optional, Set
+from typing import Dict, FrozenSet, List, Optional
 import json
 from datetime import datetime
-from dataclasses import asdict, dataclass
+from dataclasses import dataclass, replace
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from PIL import Image
 from tqdm import tqdm
 
 from blockchain.blockchain import Blockchain
 from watermarking.utils import get_image_files
-from watermarking.watermark_embedder import WatermarkEmbedder
+from watermarking.watermark_embedder import WatermarkEmbedder, EmbedderTransaction
+
+# Start the workers with spawn, a forked child inherits the parent's Numba
+# threading layer state and can hang
+_MP_CONTEXT = multiprocessing.get_context("spawn")
 
 
 @dataclass
@@ -21,15 +29,52 @@ class BatchEmbedTransaction:
     failed_images: List[str] = None
     transaction_dict: Dict[str, dict] = None
 
+    def to_dict(self) -> dict:
+        """Convert batch transaction to dictionary without asdict's recursive copy."""
+        return {
+            'processing_time': self.processing_time,
+            'total_images': self.total_images,
+            'processed_images': self.processed_images,
+            'failed_images': self.failed_images,
+            'transaction_dict': self.transaction_dict,
+        }
+
+
+def _embed_image(embedder: WatermarkEmbedder, config) -> EmbedderTransaction:
+    """Embed the watermark of one image, run in a worker process on a copy of the embedder."""
+    embedder.config = config
+    return embedder.embed_watermarks()
+
 
 class BatchEmbedderProcessor:
     def __init__(self, config):
         self.config = config
-        self.supported_formats: Set[str] = {'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.dcm'}
+        self.supported_formats: FrozenSet[str] = frozenset({'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.dcm'})
         self.embedder = WatermarkEmbedder(config)
         self.transaction_dict = {}
         self.blockchain = Blockchain(config.blockchain_path)
 
+    def _run_tasks(self, tasks: dict):
+        """
+        Embed the images of tasks, a config by image path, in worker processes.
+
+        Yields (image path, callable returning the transaction or raising the
+        embedding error) in completion order. A single image or CPU is
+        embedded in this process, where a pool would only add its start-up time.
+        """
+        workers = min(os.cpu_count() or 1, len(tasks))
+        if workers == 1:
+            for img_path, config in tasks.items():
+                # A copy, as a worker process would get, keeps self.embedder's config
+                yield img_path, partial(_embed_image, copy.copy(self.embedder), config)
+            return
+
+        with ProcessPoolExecutor(max_workers=workers, mp_context=_MP_CONTEXT) as executor:
+            futures = {executor.submit(_embed_image, self.embedder, config): img_path
+                       for img_path, config in tasks.items()}
+            for future in as_completed(futures):
+                yield futures[future], future.result
+
     def process_images(self) -> BatchEmbedTransaction:
         """
         Process all images in the configured directory.
@@ -58,21 +103,19 @@ class BatchEmbedderProcessor:
 
         print(f"Starting batch processing of {total_images} images...")
 
-        # Process each image
-        for img_path in tqdm(image_files, total=len(image_files), desc="Processing images"):
+        # Embed the images in parallel, every task gets its own config and
+        # all of them share the embedder's secret key
+        tasks = {
+            img_path: replace(self.config,
+                              data_path=str(img_path),
+                              save_path=str(save_path / f"watermarked_{img_path.name}"))
+            for img_path in image_files
+        }
+        transactions = {}
+        for img_path, get_transaction in tqdm(self._run_tasks(tasks), total=len(tasks),
+                                              desc="Processing images"):
             try:
-                print(f"\nProcessing image: {img_path.name}")
-
-                # Update config with current image paths
-                self.config.data_path = str(img_path)
-                self.config.save_path = str(save_path / f"watermarked_{img_path.name}")
-
-                # Embed watermark
-                transaction = self.embedder.embed_watermarks()
-
-                # Store transaction in dictionary using watermarked image hash as key
-                self.transaction_dict[transaction.hash_image_wat] = asdict(transaction)
-
+                transactions[img_path] = get_transaction()
                 processed_images += 1
                 print(f"Successfully processed: {img_path.name}")
 
@@ -80,6 +123,12 @@ class BatchEmbedderProcessor:
                 print(f"Error processing {img_path.name}: {str(e)}")
                 failed_images.append(str(img_path))
 
+        # Store transactions using watermarked image hash as key, in file order
+        for img_path in image_files:
+            if img_path in transactions:
+                transaction = transactions[img_path]
+                self.transaction_dict[transaction.hash_image_wat] = transaction.to_dict()
+
         processing_time = (datetime.now() - start_time).total_seconds()
 
         # Create result object
@@ -93,7 +142,7 @@ class BatchEmbedderProcessor:
 
         # # Save transaction dictionary in the blockchain
         # Add transaction
-        new_block = self.blockchain.add_transaction(asdict(batch_transaction), info="embedder")
+        new_block = self.blockchain.add_transaction(batch_transaction.to_dict(), info="embedder")
 
         # Verify chain
         is_valid = self.blockchain.verify_chain()
@@ -1,9 +1,7 @@
-import hashlib
-from copy import deepcopy
-from typing import Union, Tuple, Optional, List
+from typing import Optional
 from dataclasses import dataclass
 import numpy as np
-from PIL import Image
+from numpy.lib.stride_tricks import sliding_window_view
 from pydicom import dcmread
 from blockchain.blockchain import Blockchain
 from utils.utils import (
@@ -11,7 +9,39 @@ from utils.utils import (
     compute_ber,
     reshape_and_compute
 )
-from watermarking.utils import compute_hash, hex_to_binary_array
+from watermarking.utils import (
+    compute_hash,
+    compute_file_hash,
+    hex_to_binary_array,
+    load_grayscale_image,
+    majority_bits
+)
+from watermarking.kernels import (
+    NUMBA_AVAILABLE, NO_BIT, OVERFLOW, extract_position, pairwise_sum, window_sum, window_taps,
+    njit, prange, types
+)
+
+
+if NUMBA_AVAILABLE:
+    # Explicit signatures compile the kernels (or load them from the cache)
+    # at import time, so the first extraction does not pay for the JIT
+    _IMAGE = types.int32[:, ::1]
+    _KERNEL = types.float64[:, ::1]
+    _GRID = types.int64[:, ::1]
+    # Secret positions are cached read-only arrays
+    _POSITIONS = types.Array(types.uint8, 1, 'C', readonly=True)
+    _BITS = types.Tuple((types.int8[::1], types.int64[:, ::1]))
+    _BITS_PER_ROW = types.Tuple((types.int8[:, ::1], types.int32[::1]))
+
+    _EXTRACT_KERNEL_SIG = _BITS(_IMAGE, _KERNEL, types.int64, types.int64, types.int64, _POSITIONS)
+    _EXTRACT_PARALLEL_SIG = _BITS_PER_ROW(_IMAGE, _KERNEL, types.int64, types.int64, types.int64, _POSITIONS)
+    _EXTRACT_CROSS_SIG = _BITS_PER_ROW(_IMAGE, types.int64, types.int64, types.int64, _POSITIONS)
+    _PREDICT_SIG = types.UniTuple(_GRID, 2)(_IMAGE, _KERNEL, types.int64)
+    _EXTRACT_PREDICTED_SIG = _BITS_PER_ROW(_GRID, _GRID, types.int64, types.int64, _POSITIONS)
+    _COLLECT_SIG = _BITS(types.int8[:, ::1], types.int64)
+else:
+    _EXTRACT_KERNEL_SIG = _EXTRACT_PARALLEL_SIG = _EXTRACT_CROSS_SIG = None
+    _PREDICT_SIG = _EXTRACT_PREDICTED_SIG = _COLLECT_SIG = None
 
 
 @dataclass
@@ -23,6 +53,337 @@ class ExtractionResult:
     is_match: bool
 
 
+# Default prediction kernel, the mean of the 4 direct neighbors
+CROSS_KERNEL = np.array([[0, 1 / 4, 0], [1 / 4, 0, 1 / 4], [0, 1 / 4, 0]])
+
+
+@njit(_EXTRACT_KERNEL_SIG, cache=True)
+def _extract_kernel(image, kernel, stride, t_hi, max_pixel_value, secret_positions):
+    """
+    Compiled extraction loop.
+
+    Args:
+        image: int32 image, updated in place with the recovered pixel values
+        kernel: float64 prediction kernel
+        stride: step between two kernel positions
+        t_hi: embedding threshold
+        max_pixel_value: 2 ** bit_depth
+        secret_positions: uint8 array, 1 where a position carries a bit
+
+    Returns:
+        Tuple containing:
+            - np.ndarray: int8 extracted bits
+            - np.ndarray: (256, 2) per-bit sums and counts
+    """
+    height, width = image.shape
+    k_height, k_width = kernel.shape
+    tap_y, tap_x, weights = window_taps(kernel)
+    out_height = (height - k_height) // stride + 1
+    out_width = (width - k_width) // stride + 1
+
+    extracted_bits = np.empty(out_height * out_width, np.int8)
+    extracted_bits_256 = np.zeros((256, 2), np.int64)
+    n_bits = 0
+    overflow_count = 0
+
+    for idx_secret_key in range(out_height * out_width):
+        if secret_positions[idx_secret_key] == 0:
+            continue
+
+        # Get region coordinates
+        y_start = (idx_secret_key // out_width) * stride
+        x_start = (idx_secret_key % out_width) * stride
+
+        neighbors = int(np.floor(window_sum(image, y_start, x_start, tap_y, tap_x, weights)))
+        bit = extract_position(image, y_start + k_height // 2, x_start + k_width // 2,
+                               neighbors, t_hi, max_pixel_value)
+        if bit == OVERFLOW:
+            overflow_count += 1
+        elif bit != NO_BIT:
+            extracted_bits[n_bits] = bit
+            n_bits += 1
+            extracted_bits_256[idx_secret_key % 256, 0] += bit
+            extracted_bits_256[idx_secret_key % 256, 1] += 1
+
+    # The trailing bits carry the overflow information, not the watermark
+    if overflow_count:
+        n_bits = max(n_bits - overflow_count - 1, 0)
+    return extracted_bits[:n_bits], extracted_bits_256
+
+
+@njit(_EXTRACT_PARALLEL_SIG, parallel=True, cache=True)
+def _extract_kernel_parallel(image, kernel, stride, t_hi, max_pixel_value, secret_positions):
+    """
+    Row-parallel version of _extract_kernel.
+
+    Only valid when stride >= kernel height: a row then never reads the
+    pixels written by another row, so rows can be processed in any order.
+
+    Returns:
+        Tuple containing:
+            - np.ndarray: (out_height, out_width) int8 bits, NO_BIT where no bit was extracted
+            - np.ndarray: int32 overflow count per row
+    """
+    height, width = image.shape
+    k_height, k_width = kernel.shape
+    tap_y, tap_x, weights = window_taps(kernel)
+    out_height = (height - k_height) // stride + 1
+    out_width = (width - k_width) // stride + 1
+
+    bits_per_row = np.full((out_height, out_width), NO_BIT, np.int8)
+    overflow_per_row = np.zeros(out_height, np.int32)
+
+    for y in prange(out_height):
+        for x in range(out_width):
+            if secret_positions[y * out_width + x] == 0:
+                continue
+
+            # Get region coordinates
+            y_start = y * stride
+            x_start = x * stride
+
+            neighbors = int(np.floor(window_sum(image, y_start, x_start, tap_y, tap_x, weights)))
+            bit = extract_position(image, y_start + k_height // 2, x_start + k_width // 2,
+                                   neighbors, t_hi, max_pixel_value)
+            if bit == OVERFLOW:
+                overflow_per_row[y] += 1
+            else:
+                bits_per_row[y, x] = bit
+
+    return bits_per_row, overflow_per_row
+
+
+@njit(_EXTRACT_CROSS_SIG, parallel=True, cache=True)
+def _extract_kernel_cross3x3(image, stride, t_hi, max_pixel_value, secret_positions):
+    """
+    _extract_kernel_parallel specialised for CROSS_KERNEL.
+
+    The prediction is the sum of the 4 direct neighbors shifted right by 2,
+    which equals floor(sum / 4) without any multiplication. Requires stride >= 3.
+    """
+    height, width = image.shape
+    out_height = (height - 3) // stride + 1
+    out_width = (width - 3) // stride + 1
+
+    bits_per_row = np.full((out_height, out_width), NO_BIT, np.int8)
+    overflow_per_row = np.zeros(out_height, np.int32)
+
+    for y in prange(out_height):
+        for x in range(out_width):
+            if secret_positions[y * out_width + x] == 0:
+                continue
+
+            y_center = y * stride + 1
+            x_center = x * stride + 1
+            neighbors = (image[y_center - 1, x_center] + image[y_center + 1, x_center]
+                         + image[y_center, x_center - 1] + image[y_center, x_center + 1]) >> 2
+
+            bit = extract_position(image, y_center, x_center, neighbors, t_hi, max_pixel_value)
+            if bit == OVERFLOW:
+                overflow_per_row[y] += 1
+            else:
+                bits_per_row[y, x] = bit
+
+    return bits_per_row, overflow_per_row
+
+
+@njit(_PREDICT_SIG, parallel=True, cache=True)
+def _predict_kernel(image, kernel, stride):
+    """Compiled version of _predict_numpy."""
+    height, width = image.shape
+    k_height, k_width = kernel.shape
+    tap_y, tap_x, weights = window_taps(kernel)
+    out_height = (height - k_height) // stride + 1
+    out_width = (width - k_width) // stride + 1
+
+    centers = np.empty((out_height, out_width), np.int64)
+    neighbors = np.empty((out_height, out_width), np.int64)
+    for y in prange(out_height):
+        for x in range(out_width):
+            y_start = y * stride
+            x_start = x * stride
+            neighbors[y, x] = int(np.floor(window_sum(image, y_start, x_start, tap_y, tap_x, weights)))
+            centers[y, x] = image[y_start + k_height // 2, x_start + k_width // 2]
+    return centers, neighbors
+
+
+@njit(_PREDICT_SIG, parallel=True, cache=True)
+def _predict_kernel_3x3(image, kernel, stride):
+    """
+    _predict_kernel specialised for 3x3 kernels.
+
+    The weights are loaded once and the window sum is written out, in the
+    order of the embedder's np.sum (see window_sum) so the predictions match.
+    """
+    height, width = image.shape
+    out_height = (height - 3) // stride + 1
+    out_width = (width - 3) // stride + 1
+    k00, k01, k02 = kernel[0, 0], kernel[0, 1], kernel[0, 2]
+    k10, k11, k12 = kernel[1, 0], kernel[1, 1], kernel[1, 2]
+    k20, k21, k22 = kernel[2, 0], kernel[2, 1], kernel[2, 2]
+
+    centers = np.empty((out_height, out_width), np.int64)
+    neighbors = np.empty((out_height, out_width), np.int64)
+    for y in prange(out_height):
+        row0 = image[y * stride]
+        row1 = image[y * stride + 1]
+        row2 = image[y * stride + 2]
+        for x in range(out_width):
+            x_start = x * stride
+            # np.sum order: the first 8 terms pairwise, then the last one
+            acc = (((row0[x_start] * k00 + row0[x_start + 1] * k01)
+                    + (row0[x_start + 2] * k02 + row1[x_start] * k10))
+                   + ((row1[x_start + 1] * k11 + row1[x_start + 2] * k12)
+                      + (row2[x_start] * k20 + row2[x_start + 1] * k21))
+                   + row2[x_start + 2] * k22)
+            neighbors[y, x] = int(np.floor(acc))
+            centers[y, x] = row1[x_start + 1]
+    return centers, neighbors
+
+
+@njit(_PREDICT_SIG, parallel=True, cache=True)
+def _predict_kernel_5x5(image, kernel, stride):
+    """_predict_kernel specialised for 5x5 kernels, see _predict_kernel_3x3."""
+    height, width = image.shape
+    out_height = (height - 5) // stride + 1
+    out_width = (width - 5) // stride + 1
+    k00, k01, k02, k03, k04 = kernel[0, 0], kernel[0, 1], kernel[0, 2], kernel[0, 3], kernel[0, 4]
+    k10, k11, k12, k13, k14 = kernel[1, 0], kernel[1, 1], kernel[1, 2], kernel[1, 3], kernel[1, 4]
+    k20, k21, k22, k23, k24 = kernel[2, 0], kernel[2, 1], kernel[2, 2], kernel[2, 3], kernel[2, 4]
+    k30, k31, k32, k33, k34 = kernel[3, 0], kernel[3, 1], kernel[3, 2], kernel[3, 3], kernel[3, 4]
+    k40, k41, k42, k43, k44 = kernel[4, 0], kernel[4, 1], kernel[4, 2], kernel[4, 3], kernel[4, 4]
+
+    centers = np.empty((out_height, out_width), np.int64)
+    neighbors = np.empty((out_height, out_width), np.int64)
+    for y in prange(out_height):
+        row0 = image[y * stride]
+        row1 = image[y * stride + 1]
+        row2 = image[y * stride + 2]
+        row3 = image[y * stride + 3]
+        row4 = image[y * stride + 4]
+        for x in range(out_width):
+            x_start = x * stride
+            # np.sum order: 8 partial sums over terms i, i + 8 and i + 16,
+            # added pairwise, then the last term
+            r0 = row0[x_start] * k00 + row1[x_start + 3] * k13 + row3[x_start + 1] * k31
+            r1 = row0[x_start + 1] * k01 + row1[x_start + 4] * k14 + row3[x_start + 2] * k32
+            r2 = row0[x_start + 2] * k02 + row2[x_start] * k20 + row3[x_start + 3] * k33
+            r3 = row0[x_start + 3] * k03 + row2[x_start + 1] * k21 + row3[x_start + 4] * k34
+            r4 = row0[x_start + 4] * k04 + row2[x_start + 2] * k22 + row4[x_start] * k40
+            r5 = row1[x_start] * k10 + row2[x_start + 3] * k23 + row4[x_start + 1] * k41
+            r6 = row1[x_start + 1] * k11 + row2[x_start + 4] * k24 + row4[x_start + 2] * k42
+            r7 = row1[x_start + 2] * k12 + row3[x_start] * k30 + row4[x_start + 3] * k43
+            acc = ((r0 + r1) + (r2 + r3)) + ((r4 + r5) + (r6 + r7)) + row4[x_start + 4] * k44
+            neighbors[y, x] = int(np.floor(acc))
+            centers[y, x] = row2[x_start + 2]
+    return centers, neighbors
+
+
+def _predict_compiled(image, kernel, stride):
+    """_predict_kernel, through its unrolled version for 3x3 and 5x5 kernels."""
+    if kernel.shape == (3, 3):
+        return _predict_kernel_3x3(image, kernel, stride)
+    if kernel.shape == (5, 5):
+        return _predict_kernel_5x5(image, kernel, stride)
+    return _predict_kernel(image, kernel, stride)
+
+
+@njit(_EXTRACT_PREDICTED_SIG, parallel=True, cache=True)
+def _extract_predicted_kernel(centers, neighbors, t_hi, max_pixel_value, secret_positions):
+    """Compiled version of _extract_predicted, returns the outputs of _extract_kernel_parallel."""
+    out_height, out_width = centers.shape
+    bits_per_row = np.full((out_height, out_width), NO_BIT, np.int8)
+    overflow_per_row = np.zeros(out_height, np.int32)
+
+    for y in prange(out_height):
+        for x in range(out_width):
+            if secret_positions[y * out_width + x] == 0:
+                continue
+
+            center = centers[y, x]
+            error_w = center - neighbors[y, x]
+            if error_w < 0:
+                continue
+            if center == max_pixel_value - 1:
+                overflow_per_row[y] += 1
+            elif error_w <= (2 * t_hi + 1):
+                bits_per_row[y, x] = error_w & 1
+
+    return bits_per_row, overflow_per_row
+
+
+@njit(_COLLECT_SIG, cache=True)
+def _collect_bits(bits_per_row, overflow_count):
+    """Gather the bits of _extract_kernel_parallel in scan order."""
+    flat_bits = bits_per_row.ravel()
+    extracted_bits = np.empty(flat_bits.size, np.int8)
+    extracted_bits_256 = np.zeros((256, 2), np.int64)
+    n_bits = 0
+
+    # The flat index of a position is its index in the secret key
+    for idx_secret_key in range(flat_bits.size):
+        bit = flat_bits[idx_secret_key]
+        if bit == NO_BIT:
+            continue
+        extracted_bits[n_bits] = bit
+        n_bits += 1
+        extracted_bits_256[idx_secret_key % 256, 0] += bit
+        extracted_bits_256[idx_secret_key % 256, 1] += 1
+
+    # The trailing bits carry the overflow information, not the watermark
+    if overflow_count:
+        n_bits = max(n_bits - overflow_count - 1, 0)
+    return extracted_bits[:n_bits], extracted_bits_256
+
+
+def _predict_numpy(image, kernel, stride):
+    """
+    Center pixel and prediction of every kernel position, in a single call.
+
+    Only valid when stride >= kernel height and width: the kernel positions
+    do not overlap, so the recovered pixels are never read back and the
+    prediction only depends on the input image, the kernel and the stride.
+
+    Returns:
+        Tuple containing:
+            - np.ndarray: (out_height, out_width) int64 center pixels
+            - np.ndarray: (out_height, out_width) int64 predictions
+    """
+    k_height, k_width = kernel.shape
+    patches = sliding_window_view(image, (k_height, k_width))[::stride, ::stride]
+    # Sum the weighted taps in the order of the embedder's np.sum
+    terms = [kernel[i, j] * patches[:, :, i, j] if kernel[i, j] else None
+             for i in range(k_height) for j in range(k_width)]
+    window_sums = np.broadcast_to(pairwise_sum(terms), patches.shape[:2])
+    neighbors = np.floor(window_sums).astype(np.int64)
+    centers = patches[:, :, k_height // 2, k_width // 2].astype(np.int64)
+    return centers, neighbors
+
+
+def _extract_predicted(centers, neighbors, t_hi, max_pixel_value, secret_positions):
+    """NumPy extraction from the output of _predict_numpy."""
+    # Keep the positions selected by the secret key, in scan order
+    positions = np.flatnonzero(secret_positions[:centers.size])
+    center = centers.ravel()[positions]
+    error_w = center - neighbors.ravel()[positions]
+
+    valid = error_w >= 0
+    overflow = valid & (center == max_pixel_value - 1)
+    has_bit = valid & ~overflow & (error_w <= 2 * t_hi + 1)
+
+    extracted_bits = (error_w[has_bit] & 1).astype(np.int8)
+    buckets = positions[has_bit] % 256
+    extracted_bits_256 = np.zeros((256, 2), np.int64)
+    np.add.at(extracted_bits_256[:, 0], buckets, extracted_bits)
+    np.add.at(extracted_bits_256[:, 1], buckets, 1)
+
+    # The trailing bits carry the overflow information, not the watermark
+    overflow_count = np.count_nonzero(overflow)
+    if overflow_count:
+        extracted_bits = extracted_bits[:max(len(extracted_bits) - overflow_count - 1, 0)]
+    return extracted_bits, extracted_bits_256
+
+
 class WatermarkExtractor:
     def __init__(self, config):
         self.config = config
@@ -32,128 +393,132 @@ class WatermarkExtractor:
         """Load image based on data type."""
         if self.config.data_type == "dcm":
             return dcmread(self.config.data_path).pixel_array
-        return np.array(Image.open(self.config.data_path).convert('L'))
+        return load_grayscale_image(self.config.data_path)
 
     def _extract_watermark_from_image(
             self,
             image: np.ndarray,
-            transaction: dict
+            transaction: dict,
+            predictions: Optional[dict] = None
     ):
-        """Extract watermark from image using given parameters."""
+        """
+        Extract watermark from image using given parameters.
+
+        predictions caches the predicted image by (stride, kernel)
+        for this image, so that probing several transactions with the same
+        parameters predicts the image once.
+        """
         # Setup parameters
-        kernel = np.array(transaction["kernel"])
-        stride = transaction["stride"]
-        t_hi = transaction["t_hi"]
+        kernel = np.asarray(transaction["kernel"], dtype=np.float64)
+        stride = int(transaction["stride"])
+        t_hi = int(transaction["t_hi"])
         max_pixel_value = 2 ** transaction["bit_depth"]
 
-        # Initialize arrays
-        recovered_image = deepcopy(image)
-        extracted_bits = []
-        extracted_bits_256 = np.zeros((256, 2)).astype(np.float64)
-        pos_wat = 0
-        overflow_positions = []
-
         # Generate secret positions
-        image_size = image.size
-        secret_positions = generate_random_binary_array_from_string(
-            transaction["secret_key"],
-            image_size
-        )
+        secret_positions = generate_random_binary_array_from_string(transaction["secret_key"], image.size)
 
-        # Calculate dimensions
-        height, width = image.shape
-        k_height, k_width = kernel.shape
-        out_height = (height - k_height) // stride + 1
-        out_width = (width - k_width) // stride + 1
-        idx_secret_key = 0
-        # Extraction loop
-        for y in range(out_height):
-            for x in range(out_width):
-                if secret_positions[idx_secret_key] == 0:
-                    idx_secret_key +=1
-                    continue
+        if stride >= max(kernel.shape) and (predictions is not None or not NUMBA_AVAILABLE):
+            if predictions is None:
+                predictions = {}
+            key = (stride, kernel.shape, kernel.tobytes())
+            if key not in predictions:
+                if NUMBA_AVAILABLE:
+                    predictions[key] = _predict_compiled(np.ascontiguousarray(image, dtype=np.int32),
+                                                         kernel, stride)
+                else:
+                    predictions[key] = _predict_numpy(image, kernel, stride)
+            centers, neighbors = predictions[key]
 
-                # Get region coordinates
-                y_start = y * stride
-                x_start = x * stride
-                y_center = y_start + k_height // 2
-                x_center = x_start + k_width // 2
-
-                # Extract region and calculate values
-                region = recovered_image[y_start:y_start + k_height,
-                         x_start:x_start + k_width]
-                neighbors = np.sum(region * kernel) // 1
-                center = recovered_image[y_center, x_center]
-
-                error_w = center - neighbors
-                if error_w < 0:
-                    idx_secret_key += 1
-                    continue
+            if not NUMBA_AVAILABLE:
+                return _extract_predicted(centers, neighbors, t_hi, max_pixel_value, secret_positions)
+            bits_per_row, overflow_per_row = _extract_predicted_kernel(
+                centers, neighbors, t_hi, max_pixel_value, secret_positions
+            )
+            return _collect_bits(bits_per_row, overflow_per_row.sum())
 
-                if center == max_pixel_value - 1:
-                    overflow_positions.append((y_center, x_center))
-                    idx_secret_key += 1
-                    continue
+        # The kernels update the image in place, astype gives them their own C-ordered
+        # int32 copy, which the compiled signatures require
+        image = image.astype(np.int32, order='C')
+        secret_positions = secret_positions.astype(np.uint8, copy=False)
+        args = (image, kernel, stride, t_hi, max_pixel_value, secret_positions)
+        if stride < kernel.shape[0]:
+            # Overlapping rows depend on each other, keep the serial order
+            return _extract_kernel(*args)
 
-                # Extract bit and update image
-                error, bit = self._extraction_value(error_w, t_hi)
-                if bit in (0, 1):
-                    extracted_bits.append(bit)
-                    extracted_bits_256[idx_secret_key%256][0] += bit
-                    extracted_bits_256[idx_secret_key%256][1] += 1
-                    # if y< 1:
-                    #     print("ext pos", y, x, bit)
-                idx_secret_key += 1
-                recovered_image[y_center, x_center] = neighbors + error
-
-        if not overflow_positions:
-            return np.array(extracted_bits), np.array(extracted_bits_256)
+        if np.array_equal(kernel, CROSS_KERNEL):
+            bits_per_row, overflow_per_row = _extract_kernel_cross3x3(
+                image, stride, t_hi, max_pixel_value, secret_positions
+            )
         else:
-            return np.array(extracted_bits[:-len(overflow_positions) - 1]), np.array(extracted_bits_256)
+            bits_per_row, overflow_per_row = _extract_kernel_parallel(*args)
+        return _collect_bits(bits_per_row, overflow_per_row.sum())
 
     @staticmethod
-    def _extraction_value(error_w: int, thresh_hi: int) -> Tuple[int, Optional[int]]:
-        """Calculate extraction value and bit."""
-        if error_w > (2 * thresh_hi + 1):
-            return error_w - thresh_hi - 1, None
-        return (error_w - error_w % 2) // 2, error_w % 2
+    def _can_hold_watermark(image: np.ndarray, image_max: int, transaction: dict) -> bool:
+        """Cheap checks ruling out a transaction before running the extraction."""
+        height, width = image.shape
+        k_height, k_width = np.shape(transaction["kernel"])
+        return (image_max < 2 ** transaction["bit_depth"]
+                and k_height <= height and k_width <= width
+                and transaction["stride"] >= 1)
 
     def extract(self) -> dict:
         """Main extraction method."""
-        # Load and hash image
-        image = self._load_image()
-        image_hash = compute_hash(image)
+        if not self.config.skip_hash_lookup:
+            # Files written by the embedder are found by their content hash, without decoding
+            history, transaction = self.blockchain.get_transaction_history(
+                compute_file_hash(self.config.data_path)
+            )
+            if transaction:
+                print("A matching image hash found in blockchain")
+                history["ber"] = 0
+                return history
+
+        return self.extract_from_array(self._load_image())
+
+    def extract_from_array(self, image: np.ndarray) -> dict:
+        """Extraction method for an image already in memory, config.data_path is not read."""
         ber = 1
-        # Get transaction from blockchain
-        history, transaction = self.blockchain.get_transaction_history(image_hash)
+        if self.config.skip_hash_lookup:
+            # The caller knows the image was modified, its hash cannot be in the chain
+            history, transaction = {}, {}
+        else:
+            # Hash image, then get transaction from blockchain
+            image_hash = compute_hash(image)
+            history, transaction = self.blockchain.get_transaction_history(image_hash)
         if not transaction:
             print("No matching image hash found in blockchain")
-            blocks = self.blockchain.blocks
-            for _, block in blocks.items():
-                if block.info == "embedder":
-                    for _, transaction_current in block.transaction["transaction_dict"].items():
-                        if transaction_current["data_type"] == self.config.data_type:
-                            extracted_watermark, extracted_watermark_256 = self._extract_watermark_from_image(image, transaction_current)
-
-                            original_watermark = hex_to_binary_array(transaction_current["watermark"])
-                            extracted_watermark = reshape_and_compute(extracted_watermark)
-                            # print("ext wat", [int(i/j>0.5) for i, j in extracted_watermark_256])
-                            # print("original wat", original_watermark)
-                            extracted_watermark_256 = np.array([int(i/j>0.5) for i, j in extracted_watermark_256])
-
-                            print("extracted_watermark_256", original_watermark)
-
-                            ber = compute_ber(extracted_watermark_256, original_watermark)
-                            if ber < 0.4:
-                                history = {
-                                    'ber': ber,
-                                    'block_number': block.header.block_number,
-                                    'block_hash': block.hash,
-                                    'timestamp': block.header.timestamp,
-                                    'info': block.info,
-                                    'image_hash': transaction_current['hash_image_wat']
-                                }
-                                return history
+            image_max = image.max()
+            candidates = self.blockchain.get_transactions_by_data_type(self.config.data_type)
+            # Sharing predictions only pays off once a second candidate reuses them
+            predictions = {} if len(candidates) > 1 else None
+            for block, transaction_current in candidates:
+                if not self._can_hold_watermark(image, image_max, transaction_current):
+                    continue
+
+                extracted_watermark, extracted_watermark_256 = self._extract_watermark_from_image(
+                    image, transaction_current, predictions
+                )
+
+                original_watermark = hex_to_binary_array(transaction_current["watermark"])
+                extracted_watermark = reshape_and_compute(extracted_watermark)
+                # print("ext wat", [int(i/j>0.5) for i, j in extracted_watermark_256])
+                # print("original wat", original_watermark)
+                extracted_watermark_256 = majority_bits(extracted_watermark_256)
+
+                print("extracted_watermark_256", original_watermark)
+
+                ber = compute_ber(extracted_watermark_256, original_watermark)
+                if ber < 0.4:
+                    history = {
+                        'ber': ber,
+                        'block_number': block.header.block_number,
+                        'block_hash': block.hash,
+                        'timestamp': block.header.timestamp,
+                        'info': block.info,
+                        'image_hash': transaction_current['hash_image_wat']
+                    }
+                    return history
 
             history = {
                 'ber': 0.5,
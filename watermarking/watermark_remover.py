@@ -1,5 +1,5 @@
 import hashlib
-from copy import deepcopy
+import io
 from typing import Union, Tuple, Dict, Optional, Any
 from dataclasses import dataclass
 import numpy as np
@@ -10,7 +10,80 @@ from datetime import datetime
 
 from blockchain.blockchain import Blockchain
 from utils.utils import generate_random_binary_array_from_string, compute_ber
-from watermarking.utils import bits_to_hexdigest, hex_to_binary_array, compute_hash
+from watermarking.utils import (
+    bits_to_hexdigest,
+    hex_to_binary_array,
+    compute_hash,
+    load_grayscale_image,
+    majority_bits
+)
+from watermarking.kernels import (
+    NUMBA_AVAILABLE, NO_BIT, OVERFLOW, extract_position, pairwise_sum, window_sum, window_taps,
+    njit, types
+)
+
+if NUMBA_AVAILABLE:
+    # Compiled at import time, see watermark_extractor
+    _REMOVE_KERNEL_SIG = types.Tuple((types.int8[::1], types.int64[:, ::1], types.int64[:, ::1]))(
+        types.int32[:, ::1], types.float64[:, ::1], types.int64, types.int64, types.int64,
+        types.Array(types.uint8, 1, 'C', readonly=True)
+    )
+else:
+    _REMOVE_KERNEL_SIG = None
+
+
+@njit(_REMOVE_KERNEL_SIG, cache=True)
+def _remove_kernel(image, kernel, stride, t_hi, max_pixel_value, secret_positions):
+    """
+    Compiled removal loop, same scan as WatermarkRemove._extract_watermark.
+
+    Args:
+        image: int32 image, updated in place with the recovered pixel values
+        kernel: float64 prediction kernel
+        stride: step between two kernel positions
+        t_hi: embedding threshold
+        max_pixel_value: 2 ** bit_depth
+        secret_positions: uint8 array, 1 where a position carries a bit
+
+    Returns:
+        Tuple containing:
+            - np.ndarray: int8 extracted bits, overflow bits included
+            - np.ndarray: (n, 2) overflow center coordinates in scan order
+            - np.ndarray: (256, 2) per-bit sums and counts
+    """
+    height, width = image.shape
+    k_height, k_width = kernel.shape
+    tap_y, tap_x, weights = window_taps(kernel)
+    out_height = (height - k_height) // stride + 1
+    out_width = (width - k_width) // stride + 1
+
+    extracted_bits = np.empty(out_height * out_width, np.int8)
+    overflow_positions = np.empty((out_height * out_width, 2), np.int64)
+    extracted_bits_256 = np.zeros((256, 2), np.int64)
+    n_bits = 0
+    n_overflow = 0
+
+    for idx_secret_key in range(out_height * out_width):
+        if secret_positions[idx_secret_key] == 0:
+            continue
+
+        y_center = (idx_secret_key // out_width) * stride + k_height // 2
+        x_center = (idx_secret_key % out_width) * stride + k_width // 2
+
+        neighbors = int(np.floor(window_sum(image, y_center - k_height // 2, x_center - k_width // 2,
+                                            tap_y, tap_x, weights)))
+        bit = extract_position(image, y_center, x_center, neighbors, t_hi, max_pixel_value)
+        if bit == OVERFLOW:
+            overflow_positions[n_overflow, 0] = y_center
+            overflow_positions[n_overflow, 1] = x_center
+            n_overflow += 1
+        elif bit != NO_BIT:
+            extracted_bits[n_bits] = bit
+            n_bits += 1
+            extracted_bits_256[idx_secret_key % 256, 0] += bit
+            extracted_bits_256[idx_secret_key % 256, 1] += 1
+
+    return extracted_bits[:n_bits], overflow_positions[:n_overflow], extracted_bits_256
 
 
 @dataclass
@@ -20,7 +93,7 @@ class RemoveResult:
     extracted_watermark: str
     original_watermark: np.ndarray
     ber: float
-    transaction: Dict
+    transaction: 'RemovalTransaction'
 
 
 @dataclass
@@ -36,19 +109,34 @@ class RemovalTransaction:
     extracted_watermark: str = ""
     removal_parameters: Dict = None
 
+    def to_dict(self) -> dict:
+        """Convert transaction to dictionary (shallow, removal_parameters is shared)."""
+        return vars(self).copy()
+
+
+# Size of the per-band temporaries of the vectorized removal, about what
+# stays in L2 cache
+_BAND_BYTES = 1 << 18
+
 
 class WatermarkRemove:
-    def __init__(self, config):
+    def __init__(self, config, blockchain: Optional[Blockchain] = None):
         self.config = config
-        self.blockchain = Blockchain(config.blockchain_path)
+        # Batch processing shares one loaded blockchain across images
+        self.blockchain = blockchain if blockchain is not None else Blockchain(config.blockchain_path)
 
-    def _load_image(self) -> Tuple[np.ndarray, Optional[dcmread]]:
-        """Load image and return array and DICOM dataset if applicable."""
+    def _load_image(self, file_bytes: Optional[bytes] = None) -> Tuple[np.ndarray, Optional[dcmread]]:
+        """
+        Load image and return array and DICOM dataset if applicable.
+
+        file_bytes is the content of config.data_path when the caller has
+        already read the file, it is decoded instead of reading the path.
+        """
+        source = self.config.data_path if file_bytes is None else io.BytesIO(file_bytes)
         if self.config.data_type == "dcm":
-            ds = dcmread(self.config.data_path)
-            return np.array(ds.pixel_array), ds
-        image = Image.open(self.config.data_path).convert('L')
-        return np.array(image), None
+            ds = dcmread(source)
+            return np.asarray(ds.pixel_array), ds
+        return load_grayscale_image(source), None
 
     def _extract_watermark(self, image: np.ndarray, transaction: Dict):
         """Extract watermark from image using transaction parameters."""
@@ -58,12 +146,6 @@ class WatermarkRemove:
         t_hi = transaction["t_hi"]
         max_pixel_value = 2 ** transaction["bit_depth"]
 
-        # Initialize arrays
-        recovered_image = deepcopy(image)
-        extracted_bits = []
-        overflow_positions = []
-        extracted_bits_256 = np.zeros((256, 2)).astype(np.float64)
-
         # Generate secret positions
         image_size = image.size
         secret_positions = generate_random_binary_array_from_string(
@@ -71,75 +153,173 @@ class WatermarkRemove:
             image_size
         )
 
+        if NUMBA_AVAILABLE:
+            return self._extract_watermark_compiled(
+                image, kernel, stride, t_hi, max_pixel_value, secret_positions
+            )
+
+        recovered_image = image.copy()
+
         # Calculate dimensions
         height, width = image.shape
         k_height, k_width = kernel.shape
         out_height = (height - k_height) // stride + 1
         out_width = (width - k_width) // stride + 1
 
-        idx_secret_key = 0
-        # Extraction loop
-        for y in range(out_height):
-            for x in range(out_width):
-                if secret_positions[idx_secret_key] == 0:
-                    idx_secret_key += 1
-                    continue
-
-                # Get region coordinates
-                y_start = y * stride
-                x_start = x * stride
-                y_center = y_start + k_height // 2
-                x_center = x_start + k_width // 2
-
-                # Extract region and calculate values
-                region = recovered_image[y_start:y_start + k_height,
-                         x_start:x_start + k_width]
-                neighbors = np.sum(region * kernel) // 1
-                center = recovered_image[y_center, x_center]
-
-                error_w = center - neighbors
-                if error_w < 0:
-                    idx_secret_key += 1
-                    continue
-
-                if center == max_pixel_value - 1:
-                    overflow_positions.append((y_center, x_center))
-                    idx_secret_key += 1
-                    continue
-
-                # Extract bit and update image
-                error, bit = self._extraction_value(error_w, t_hi)
-                if bit in (0, 1):
-                    extracted_bits.append(bit)
-                    extracted_bits_256[idx_secret_key%256][0] += bit
-                    extracted_bits_256[idx_secret_key%256][1] += 1
-                    # if bit in (0, 1) and y < 1:
-                    #     print("pos embed =", y, x, bit)
-                        # idx_wat += 1
-                idx_secret_key += 1
-                recovered_image[y_center, x_center] = neighbors + error
-        extracted_watermark_256 = np.array([int(i / j > 0.5) for i, j in extracted_bits_256])
-        return recovered_image, np.array(extracted_bits), overflow_positions, extracted_watermark_256
+        if stride >= max(k_height, k_width):
+            # Windows do not overlap, so no position depends on an earlier recovery
+            return self._extract_watermark_vectorized(
+                recovered_image, kernel, stride, t_hi, max_pixel_value, secret_positions
+            )
+
+        # Initialize arrays, sized for the worst case and trimmed at the end
+        extracted_bits = np.empty(out_height * out_width, dtype=np.int8)
+        bit_positions = np.empty(out_height * out_width, dtype=np.int64)
+        overflow_positions = np.empty((out_height * out_width, 2), dtype=np.int64)
+        n_bits = 0
+        n_overflow = 0
+
+        # Extraction loop, over the positions selected by the secret key only
+        active_positions = np.flatnonzero(secret_positions[:out_height * out_width])
+        for idx_secret_key in active_positions.tolist():
+            y, x = divmod(idx_secret_key, out_width)
+
+            # Get region coordinates
+            y_start = y * stride
+            x_start = x * stride
+            y_center = y_start + k_height // 2
+            x_center = x_start + k_width // 2
+
+            # Extract region and calculate values
+            region = recovered_image[y_start:y_start + k_height,
+                     x_start:x_start + k_width]
+            neighbors = int(np.sum(region * kernel) // 1)
+            center = int(recovered_image[y_center, x_center])
+
+            error_w = center - neighbors
+            if error_w < 0:
+                continue
+
+            if center == max_pixel_value - 1:
+                overflow_positions[n_overflow] = (y_center, x_center)
+                n_overflow += 1
+                continue
+
+            if error_w > 2 * t_hi + 1:
+                # Shifted position, no bit
+                recovered_image[y_center, x_center] = neighbors + error_w - t_hi - 1
+                continue
+
+            # Extract bit and update image, error_w >= 0 so & 1 and >> 1 match % 2 and // 2
+            bit = error_w & 1
+            extracted_bits[n_bits] = bit
+            bit_positions[n_bits] = idx_secret_key
+            n_bits += 1
+            recovered_image[y_center, x_center] = neighbors + (error_w >> 1)
+
+        # Per-bit sums and counts in one pass over the extracted bits
+        extracted_bits_256 = np.zeros((256, 2), dtype=np.int64)
+        buckets = bit_positions[:n_bits] % 256
+        np.add.at(extracted_bits_256[:, 0], buckets, extracted_bits[:n_bits])
+        np.add.at(extracted_bits_256[:, 1], buckets, 1)
+        extracted_watermark_256 = majority_bits(extracted_bits_256)
+        return (recovered_image, extracted_bits[:n_bits], overflow_positions[:n_overflow],
+                extracted_watermark_256)
 
     @staticmethod
-    def _extraction_value(error_w: int, thresh_hi: int) -> Tuple[int, Optional[int]]:
-        """Calculate extraction value and bit."""
-        if error_w > (2 * thresh_hi + 1):
-            return error_w - thresh_hi - 1, None
-        bit = error_w % 2
-        return (error_w - bit) // 2, bit
+    def _extract_watermark_compiled(image: np.ndarray,
+                                    kernel: np.ndarray,
+                                    stride: int,
+                                    t_hi: int,
+                                    max_pixel_value: int,
+                                    secret_positions: np.ndarray):
+        """_extract_watermark through the compiled _remove_kernel."""
+        # The kernel recovers its own C-ordered int32 copy in place, as its signature requires
+        recovered_image = image.astype(np.int32, order='C')
+        extracted_bits, overflow_positions, extracted_bits_256 = _remove_kernel(
+            recovered_image, kernel.astype(np.float64), int(stride), int(t_hi),
+            int(max_pixel_value), secret_positions
+        )
+        return (recovered_image.astype(image.dtype), extracted_bits, overflow_positions,
+                majority_bits(extracted_bits_256))
+
+    @staticmethod
+    def _extract_watermark_vectorized(recovered_image: np.ndarray,
+                                      kernel: np.ndarray,
+                                      stride: int,
+                                      t_hi: int,
+                                      max_pixel_value: int,
+                                      secret_positions: np.ndarray):
+        """
+        Vectorized _extract_watermark for non-overlapping windows, recovers the image in place.
+        """
+        height, width = recovered_image.shape
+        k_height, k_width = kernel.shape
+        out_height = (height - k_height) // stride + 1
+        out_width = (width - k_width) // stride + 1
+
+        # Work on bands of output rows so that the temporaries of a band stay
+        # in cache, windows of different bands do not overlap
+        band_rows = max(1, _BAND_BYTES // (8 * out_width))
+        taps = list(np.ndenumerate(kernel))
+
+        extracted_bits = []
+        overflow_positions = []
+        extracted_bits_256 = np.zeros((256, 2), dtype=np.int64)
+        for y0 in range(0, out_height, band_rows):
+            rows = min(band_rows, out_height - y0)
+            band = recovered_image[y0 * stride:]
+
+            # Weighted sum of one strided slice per non-zero kernel tap, only the
+            # window positions are computed, added in the embedder's np.sum order
+            terms = [weight * band[i:i + (rows - 1) * stride + 1:stride,
+                                   j:j + (out_width - 1) * stride + 1:stride] if weight else None
+                     for (i, j), weight in taps]
+            neighbors = np.broadcast_to(pairwise_sum(terms), (rows, out_width))
+            neighbors = np.floor(neighbors).astype(np.int64)
+
+            center_view = band[k_height // 2::stride, k_width // 2::stride][:rows, :out_width]
+            centers = center_view.astype(np.int64)
+            error_w = centers - neighbors
+
+            # Same decisions as the loop, in scan order
+            used = secret_positions[y0 * out_width:(y0 + rows) * out_width].reshape(rows, out_width).astype(bool)
+            used &= error_w >= 0
+            overflow = used & (centers == max_pixel_value - 1)
+            used &= ~overflow
+            has_bit = used & (error_w <= 2 * t_hi + 1)
+
+            recovered = np.where(has_bit, neighbors + (error_w >> 1), neighbors + error_w - t_hi - 1)
+            center_view[used] = recovered[used]
+
+            bits = error_w[has_bit] & 1
+            bit_index = (np.flatnonzero(has_bit) + y0 * out_width) % 256
+            np.add.at(extracted_bits_256[:, 0], bit_index, bits)
+            np.add.at(extracted_bits_256[:, 1], bit_index, 1)
+            extracted_bits.append(bits)
+            overflow_positions.append(np.argwhere(overflow) * stride + (y0 * stride + k_height // 2, k_width // 2))
+
+        extracted_bits = np.concatenate(extracted_bits)
+        overflow_positions = np.concatenate(overflow_positions)
+
+        return recovered_image, extracted_bits, overflow_positions, majority_bits(extracted_bits_256)
 
     @staticmethod
     def _handle_overflow(recovered_image: np.ndarray,
                          extracted_bits: np.ndarray,
-                         overflow_positions: list) -> ndarray:
+                         overflow_positions: np.ndarray) -> ndarray:
         """Handle overflow positions in extraction."""
-        if not overflow_positions:
-            return recovered_image, extracted_bits
+        if not len(overflow_positions):
+            return recovered_image
+        if len(overflow_positions) > len(extracted_bits):
+            # np.subtract.at would broadcast the bits over the positions
+            raise IndexError(f"{len(overflow_positions)} overflow positions for "
+                             f"{len(extracted_bits)} extracted bits")
 
         overflow_wat = extracted_bits[-len(overflow_positions):]
-        for idx, pos in enumerate(overflow_positions):
-            recovered_image[pos] -= overflow_wat[idx]
+        np.subtract.at(recovered_image,
+                       (overflow_positions[:, 0], overflow_positions[:, 1]),
+                       overflow_wat.astype(recovered_image.dtype))
 
         return recovered_image
 
@@ -148,20 +328,24 @@ class WatermarkRemove:
                       extracted_watermark: str,
                       dicom_ds: Optional[dcmread]) -> None:
         """Save recovered image and extracted watermark."""
-        # Save extracted watermark
-        np.save(self.config.ext_wat_path, extracted_watermark)
+        # Save extracted watermark, the batch remover saves it once for the whole batch
+        if self.config.ext_wat_path is not None:
+            np.save(self.config.ext_wat_path, extracted_watermark)
 
         # Save recovered image
         if dicom_ds is not None:
             dicom_ds.PixelData = recovered_image.tobytes()
             dicom_ds.save_as(self.config.save_path)
         else:
-            Image.fromarray(np.uint8(recovered_image)).save(self.config.save_path)
+            # Already uint8 for images loaded by _load_image, so no copy is made
+            Image.fromarray(recovered_image.astype(np.uint8, copy=False)).save(self.config.save_path)
 
     def extract_and_remove(self) -> RemoveResult:
         """Main method to extract watermark and recover original image."""
-        # Load image
-        image, dicom_ds = self._load_image()
+        return self.remove_from_array(*self._load_image())
+
+    def remove_from_array(self, image: np.ndarray, dicom_ds: Optional[dcmread] = None) -> RemoveResult:
+        """Removal for an image already loaded by _load_image, config.data_path is not read."""
         image_hash = compute_hash(image)
         # Get transaction from blockchain
         _, transaction = self.blockchain.get_transaction_history(image_hash)
@@ -206,7 +390,7 @@ class WatermarkRemove:
                 "t_hi": transaction["t_hi"],
                 "bit_depth": transaction["bit_depth"]
             }
-        ).__dict__
+        )
 
         # Save results
         self._save_results(recovered_image, extracted_watermark, dicom_ds)
@@ -1,13 +1,16 @@
+import multiprocessing
 import os
+from collections import deque
 from pathlib import Path
-from typing import Dict, List, Optional, Set
+from typing import Dict, FrozenSet, List, Optional
 import json
 from datetime import datetime
-from dataclasses import asdict, dataclass
-from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 import logging
 from tqdm import tqdm
 
+import numpy as np
 from PIL import Image
 
 from watermarking.utils import get_image_files
@@ -25,36 +28,116 @@ class BatchRemoveTransaction:
     transaction_dict: Dict[str, dict] = None
     average_ber: float = 0.5
 
+    def to_dict(self) -> dict:
+        """Convert batch transaction to dictionary without asdict's recursive copy."""
+        return {
+            'processing_time': self.processing_time,
+            'total_images': self.total_images,
+            'processed_images': self.processed_images,
+            'failed_images': self.failed_images,
+            'transaction_dict': self.transaction_dict,
+            'average_ber': self.average_ber,
+        }
+
+
+# Threads reading the image files ahead of the worker processes
+_LOADER_THREADS = 4
+# Files read or being processed at once, per worker process
+_PREFETCH_PER_WORKER = 2
+# Start the workers with spawn, a forked child inherits the parent's Numba
+# threading layer state and can hang
+_MP_CONTEXT = multiprocessing.get_context("spawn")
+
+# Blockchain of the batch, set once per worker process by _init_worker
+_worker_blockchain: Optional[Blockchain] = None
+
+
+def _init_worker(blockchain: Blockchain) -> None:
+    """Give the worker process the blockchain already loaded by the batch processor."""
+    global _worker_blockchain
+    _worker_blockchain = blockchain
+
+
+def _remove_image(config, file_bytes: bytes) -> tuple:
+    """Decode and process a single image, read by a loader thread, in a worker process and return results."""
+    img_path = Path(config.data_path)
+    try:
+        remover = WatermarkRemove(config, blockchain=_worker_blockchain)
+        result = remover.remove_from_array(*remover._load_image(file_bytes))
+
+        return (
+            img_path,
+            True,
+            result.transaction,
+            result.ber
+        )
+
+    except Exception as e:
+        print(f"Error processing {img_path.name}: {str(e)}")
+        return img_path, False, None, None
+
 
 class BatchRemoveProcessor:
     def __init__(self, config):
         self.config = config
-        self.supported_formats: Set[str] = {'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.dcm'}
+        self.supported_formats: FrozenSet[str] = frozenset({'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.dcm'})
         self.blockchain = Blockchain(config.blockchain_path)
 
-    def process_single_image(self, img_path: Path, rec_path: Path, wat_path: Path) -> tuple:
-        """Process a single image and return results."""
+    @staticmethod
+    def _read_file(config) -> tuple:
+        """
+        Read one image file in a loader thread, returns its config and content or None.
+
+        The worker decodes the content, only the file bytes are sent to it
+        rather than the decoded array and DICOM dataset.
+        """
         try:
-            # Update config for current image
-            self.config.data_path = str(img_path)
-            save_name = f"recovered_{img_path.name}"
-            self.config.save_path = str(rec_path) + "/" + save_name
-            self.config.ext_wat_path = str(wat_path) + '.npy'
-
-            # Create extractor and process image
-            extractor = WatermarkRemove(self.config)
-            result = extractor.extract_and_remove()
-
-            return (
-                img_path,
-                True,
-                result.transaction,
-                result.ber
-            )
+            return config, Path(config.data_path).read_bytes()
+        except OSError as e:
+            print(f"Error processing {Path(config.data_path).name}: {str(e)}")
+            return config, None
+
+    def _run_pipeline(self, tasks: List) -> Dict[Path, tuple]:
+        """
+        Remove the watermarks of the tasks, loader threads reading the next
+        image files while the worker processes recover the current ones.
+
+        Returns:
+            Dict[Path, tuple]: (success, transaction, ber) by image path
+        """
+        workers = os.cpu_count() or 1
+        max_pending = _PREFETCH_PER_WORKER * workers
+        pending_tasks = deque(tasks)
+        loading, running = set(), set()
+        results = {}
+
+        with ThreadPoolExecutor(max_workers=_LOADER_THREADS) as loader, \
+                ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                    initargs=(self.blockchain,),
+                                    mp_context=_MP_CONTEXT) as executor, \
+                tqdm(total=len(tasks), desc="Processing images") as progress:
+            while pending_tasks or loading or running:
+                # Bounded prefetch, only max_pending files are held in memory
+                while pending_tasks and len(loading) + len(running) < max_pending:
+                    loading.add(loader.submit(self._read_file, pending_tasks.popleft()))
+
+                done, _ = wait(loading | running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in loading:
+                        loading.remove(future)
+                        config, file_bytes = future.result()
+                        if file_bytes is None:
+                            results[Path(config.data_path)] = False, None, None
+                            progress.update()
+                        else:
+                            running.add(executor.submit(_remove_image, config, file_bytes))
+                    else:
+                        running.remove(future)
+                        img_path, success, transaction, ber = future.result()
+                        results[img_path] = success, transaction, ber
+                        progress.update()
 
-        except Exception as e:
-            print(f"Error processing {img_path.name}: {str(e)}")
-            return img_path, False, None, None
+        return results
 
     def process_images(self) -> BatchRemoveTransaction:
         """Process all images in the configured directory."""
@@ -74,28 +157,39 @@ class BatchRemoveProcessor:
             save_path.mkdir(parents=True, exist_ok=True)
             ext_wat_path.mkdir(parents=True, exist_ok=True)
 
-            # Process images using thread pool
+            # Process images in parallel, every task gets its own config and
+            # the workers share the blockchain loaded by this processor, with
+            # its image hash index built once for the whole batch. The workers
+            # do not save the extracted watermark, see below
+            self.blockchain.build_hash_index()
+            tasks = [
+                replace(self.config,
+                        data_path=str(img_path),
+                        save_path=str(save_path / f"recovered_{img_path.name}"),
+                        ext_wat_path=None)
+                for img_path in image_files
+            ]
+            results = self._run_pipeline(tasks)
+
+            # Collect results in file order
             successful_extractions = {}
             failed_images = []
             image_transactions = {}
-
-            with ThreadPoolExecutor() as executor:
-                # futures = [executor.submit(self.process_single_image, img_path)
-                #            for img_path in image_files]
-
-                futures = [self.process_single_image(img_path, save_path, ext_wat_path)
-                           for img_path in image_files]
-
-                # Process results with progress bar
-                for future in tqdm(futures, total=len(futures), desc="Processing images"):
-                    img_path, success, transaction, ber = future  # .result()
-
-                    if success:
-                        image_hash = transaction["watermarked_image_hash"]
-                        successful_extractions[image_hash] = ber
-                        image_transactions[image_hash] = transaction
-                    else:
-                        failed_images.append(str(img_path))
+            last_transaction = None
+            for img_path in image_files:
+                success, transaction, ber = results[img_path]
+                if success:
+                    image_hash = transaction.watermarked_image_hash
+                    successful_extractions[image_hash] = ber
+                    image_transactions[image_hash] = transaction.to_dict()
+                    last_transaction = transaction
+                else:
+                    failed_images.append(str(img_path))
+
+            # Every image used to overwrite the same watermark file, write it
+            # once with the last image in file order
+            if last_transaction is not None:
+                np.save(str(ext_wat_path) + '.npy', last_transaction.extracted_watermark)
 
             # Calculate statistics
             processed_images = len(successful_extractions)
@@ -115,7 +209,7 @@ class BatchRemoveProcessor:
             )
 
             # # Add to blockchain
-            new_block = self.blockchain.add_transaction(asdict(batch_transaction), info="remover")
+            new_block = self.blockchain.add_transaction(batch_transaction.to_dict(), info="remover")
 
             # Verify chain
             is_valid = self.blockchain.verify_chain()